@@ -11,19 +11,28 @@
 #
 # pip3 install wakeonlan
 # (For wake-on-lan functionality)
+#
+# pip3 install pybase64
+# (Optional, for faster decoding of email attachments)
 
 # Discord dependencies
 import discord
 
 # Gmail dependencies
 import pickle
-import os.path
+import os
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+import google_auth_httplib2
+import httplib2
 
 # Async dependencies
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # wol dependencies
 from wakeonlan import send_magic_packet
@@ -32,17 +41,75 @@ from wakeonlan import send_magic_packet
 import requests
 
 # General dependencies
+import logging
+from logging.handlers import RotatingFileHandler
 import time
 from datetime import date
-import base64
-from os import listdir
-from os.path import isfile, join
-from os import remove
+import io
+import binascii
+import json
 import yaml
 
+# Falls back to the standard library decoder when pybase64 isn't installed
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# Logging setup, to a rotating file instead of blocking stdout writes on the event loop
+log = logging.getLogger('pibot')
+logging.basicConfig(
+    level=logging.WARNING,
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+    handlers=[RotatingFileHandler('piDiscordBot.log', maxBytes=1024 * 1024, backupCount=3)])
+
 # Gmail token setup
-# If modifying these scopes, delete the file token.pickle.
+# If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+TOKEN_FILE = 'token.json'
+# Token file written by older versions, migrated to TOKEN_FILE on first run
+LEGACY_TOKEN_FILE = 'token.pickle'
+
+# Seconds before a Gmail HTTP request gives up
+GMAIL_HTTP_TIMEOUT = 30
+
+# Maps the url-safe base64 alphabet onto the standard one, for binascii
+URLSAFE_TO_STANDARD_B64 = str.maketrans('-_', '+/')
+
+# Gmail caps a batch request at 100 calls but rate-limits batches over 50, and caps a batchModify call at 1000 ids
+GMAIL_BATCH_SIZE = 50
+GMAIL_BATCH_MODIFY_SIZE = 1000
+# Attachments come back in one multipart response held in memory, so only a few multi-MB photos per batch
+GMAIL_ATTACHMENT_BATCH_SIZE = 5
+
+# Discord allows 10 attachments per message, and caps the total upload size of a message
+DISCORD_MAX_ATTACHMENTS = 10
+DISCORD_MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+# Attempts made at a Gmail call before giving up, and the HTTP statuses worth retrying
+RETRY_ATTEMPTS = 3
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# Gmail also reports user rate limits as a 403 with one of these reasons
+GMAIL_RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED'}
+
+# Attachment file extensions that get uploaded to Discord as photos
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Partial response mask for emails whose parts (text and attachments) get sent to Discord
+GMAIL_PARTS_FIELDS = 'id,payload(parts(filename,mimeType,body(attachmentId,data)))'
+
+# Discord channel id -> lock, held while one email's messages are posted so they don't interleave
+discordChannelLocks = {}
+
+# The Gmail client's httplib2 transport isn't thread-safe, so its blocking calls share a single worker thread
+gmailExecutor = ThreadPoolExecutor(max_workers=1)
+
+# Today's Gmail search query, only changes at midnight
+todayQueryCache = {'day': None, 'query': None}
+
+# Gmail label name -> id map, refreshed once it's older than a day
+GMAIL_LABEL_CACHE_TTL = 24 * 60 * 60
+gmailLabelCache = {'labels': None, 'fetched': 0}
 
 def gmailInitialize(loadedConfig):
     """Gets the Gmail service
@@ -54,11 +121,15 @@ def gmailInitialize(loadedConfig):
     """
 
     creds = None
+    saveCreds = False
 
-    # Loading credentials from pickle
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    # Loading credentials from json
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    elif os.path.exists(LEGACY_TOKEN_FILE):
+        with open(LEGACY_TOKEN_FILE, 'rb') as token:
             creds = pickle.load(token)
+        saveCreds = True
     # If no valid creds, let user log in
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -67,14 +138,175 @@ def gmailInitialize(loadedConfig):
             flow = InstalledAppFlow.from_client_secrets_file(
                 loadedConfig['gmail']['credFile'], SCOPES)
             creds = flow.run_local_server(port=0)
-        # Save credentials for next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    service = build('gmail', 'v1', credentials=creds)
+        saveCreds = True
+    if saveCreds:
+        # Save credentials for next run, replacing the old file atomically so a crash can't leave a half-written token
+        tmpTokenFile = TOKEN_FILE + '.tmp'
+        with open(tmpTokenFile, 'w') as token:
+            token.write(creds.to_json())
+        os.replace(tmpTokenFile, TOKEN_FILE)
+        if os.path.exists(LEGACY_TOKEN_FILE):
+            os.remove(LEGACY_TOKEN_FILE)
+
+    # One authorized connection reused (kept alive) for every Gmail call, and no discovery doc cache on disk
+    authorizedHttp = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT))
+    service = build('gmail', 'v1', http=authorizedHttp, cache_discovery=False)
     return service
 
-def getUnreadEmails(labelId, gmailService):
+def getTodayQuery():
+    """Gets the Gmail search query for emails received today, only rebuilding it when the day changes
+
+    Returns:
+      String Gmail query, in the form after:<timestamp of midnight today>
+    """
+
+    today = date.today()
+    if todayQueryCache['day'] != today:
+        # Gmail's after tag breaks for most emails if you include a .0, so the timestamp needs to be an int
+        todayQueryCache['day'] = today
+        todayQueryCache['query'] = 'after:' + str(int(time.mktime(today.timetuple())))
+    return todayQueryCache['query']
+
+def decodeUrlsafeBase64(data):
+    """Decodes url-safe base64 text, as Gmail returns it, without first copying it to bytes
+
+    Args:
+      data: Url-safe base64 str to decode
+    Returns:
+      Decoded bytes
+    """
+
+    if pybase64 is not None:
+        return pybase64.urlsafe_b64decode(data)
+    # base64.urlsafe_b64decode would encode and translate its own copies, binascii takes the str directly
+    return binascii.a2b_base64(data.translate(URLSAFE_TO_STANDARD_B64))
+
+async def runBlocking(fn, *args, **kwargs):
+    """Runs a blocking Gmail client call on the Gmail worker thread, so it doesn't stall the Discord event loop
+
+    Args:
+      fn: Blocking function to call
+      *args: Arguments to pass into fn
+      **kwargs: Keyword arguments to pass into fn
+    Returns:
+      The return value of fn
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(gmailExecutor, functools.partial(fn, *args, **kwargs))
+
+def getErrorReasons(error):
+    """Gets the error reasons from the JSON body of a Gmail HTTP error
+
+    Args:
+      error: googleapiclient HttpError
+    Returns:
+      Set of reason strings (empty if the body has none)
+    """
+
+    try:
+        errorBody = json.loads(error.content)['error']
+        return {detail.get('reason') for detail in errorBody.get('errors', []) + errorBody.get('details', [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+def isRetryableError(error):
+    """Checks whether a Gmail HTTP error is transient, and worth retrying
+
+    Args:
+      error: googleapiclient HttpError
+    Returns:
+      True for 429 and 5xx errors, and for 403 errors caused by a Gmail rate limit
+    """
+
+    status = int(error.resp.status)
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and not GMAIL_RATE_LIMIT_REASONS.isdisjoint(getErrorReasons(error))
+
+def getRetryAfter(error):
+    """Gets the Retry-After delay from a Gmail HTTP error
+
+    Args:
+      error: googleapiclient HttpError
+    Returns:
+      Retry-After seconds, or None if not sent
+    """
+
+    try:
+        return float(error.resp.get('retry-after'))
+    except (TypeError, ValueError):
+        # Retry-After can also be an HTTP date, in which case the regular backoff is used
+        return None
+
+async def withRetry(asyncFn, *args, **kwargs):
+    """Calls an async Gmail function, retrying with exponential backoff when Gmail returns a transient error
+    (Discord sends aren't wrapped, discord.py already retries their rate limits and 5xx errors itself)
+
+    Args:
+      asyncFn: Async function to call
+      *args: Arguments to pass into asyncFn
+      **kwargs: Keyword arguments to pass into asyncFn
+    Returns:
+      The return value of asyncFn, raises the last error once all attempts have failed
+    """
+
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await asyncFn(*args, **kwargs)
+        except HttpError as e:
+            if not isRetryableError(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            retryAfter = getRetryAfter(e)
+            await asyncio.sleep(retryAfter if retryAfter is not None else 2 ** attempt)
+
+async def executeBatch(gmailService, batchRequests, storeResponse):
+    """Executes Gmail requests as a batch, retrying with exponential backoff only the requests that hit a transient error
+
+    Args:
+      gmailService: Gmail service
+      batchRequests: Dict of Gmail requests to batch, keyed by request id
+      storeResponse: Function called with (requestId, response) for each successful request
+    Returns:
+      Dict of the errors of requests that still failed, keyed by request id
+    """
+
+    errors = {}
+    pending = batchRequests
+    attemptErrors = {}
+
+    # Gmail reports errors, rate limits included, per request in a batch, so they reach here rather than raising
+    def storeResult(requestId, response, exception):
+        if exception is not None:
+            attemptErrors[requestId] = exception
+        else:
+            storeResponse(requestId, response)
+
+    async def executePending():
+        batch = gmailService.new_batch_http_request(callback=storeResult)
+        for requestId, request in pending.items():
+            batch.add(request, request_id=requestId)
+        await runBlocking(batch.execute)
+
+    for attempt in range(RETRY_ATTEMPTS):
+        attemptErrors.clear()
+        await withRetry(executePending)
+
+        pending = {}
+        retryAfters = []
+        for requestId, error in attemptErrors.items():
+            if attempt < RETRY_ATTEMPTS - 1 and isinstance(error, HttpError) and isRetryableError(error):
+                pending[requestId] = batchRequests[requestId]
+                retryAfters.append(getRetryAfter(error))
+            else:
+                errors[requestId] = error
+        if not pending:
+            break
+        # Wait out the longest Retry-After Gmail sent, otherwise back off exponentially
+        await asyncio.sleep(max((retryAfter for retryAfter in retryAfters if retryAfter is not None), default=2 ** attempt))
+
+    return errors
+
+async def getUnreadEmails(labelId, gmailService):
     """Gets all unread emails from Gmail with a certain label
 
     Args:
@@ -87,118 +319,197 @@ def getUnreadEmails(labelId, gmailService):
     emails = []
 
     try:
-        # Gmail's after tag breaks for most emails if you include a .0, so we need to remove that with rstrip
-        query = 'after:'+(str(time.mktime(date.today().timetuple()))).rstrip('0').rstrip('.')
-        emailResults = gmailService.users().messages().list(userId='me', labelIds=[labelId, 'UNREAD'], q=query).execute()
+        query = getTodayQuery()
+        emailResults = await withRetry(runBlocking, gmailService.users().messages().list(userId='me', labelIds=[labelId, 'UNREAD'], q=query).execute)
 
         if 'messages' in emailResults:
             emails.extend(emailResults['messages'])
 
         while 'nextPageToken' in emailResults:
             page_token = emailResults['nextPageToken']
-            response = gmailService.users().messages().list(userId='me', labelIds=[labelId, 'UNREAD'], q=query, pageToken=page_token).execute()
-            emails.extend(response['messages'])
+            emailResults = await withRetry(runBlocking, gmailService.users().messages().list(userId='me', labelIds=[labelId, 'UNREAD'], q=query, pageToken=page_token).execute)
+            emails.extend(emailResults.get('messages', []))
 
         return emails
     except Exception as e:
-        print(e)
-        print('exception getUnreadEmails')
+        log.error('exception getUnreadEmails: %s', e)
         return emails
 
-def downloadPhotosFromEmail(gmailService, emailData):
-    """Downloads all attached photos from a passed-in email
+async def getEmailsData(gmailService, emails, **getArgs):
+    """Gets the email data for a list of emails, using batched Gmail requests
 
     Args:
       gmailService: Gmail service
-      emailData: Email data to get photos from
+      emails: Array of emails, as returned by getUnreadEmails
+      **getArgs: Extra arguments for messages().get(), to limit the returned email data (format, fields, ...)
     Returns:
-      Void, downloads attached photos to subdirectory downloadedGmailPhotos
+      Dict of email data, keyed by message id
     """
 
-    msgId = emailData['id']
+    emailsData = {}
 
-    counter = 0
-    for part in emailData['payload']['parts']:
-        if '.jpg' in part['filename']:
-            attachInfo = gmailService.users().messages().attachments().get(userId='me', messageId=msgId, id=part['body']['attachmentId']).execute()
+    def storeEmailData(requestId, response):
+        emailsData[requestId] = response
 
-            attachData = attachInfo['data']
-            file_data = base64.urlsafe_b64decode(attachData.encode('UTF-8'))
+    try:
+        for emailsChunk in divideBy(emails, GMAIL_BATCH_SIZE):
+            emailRequests = {email['id']: gmailService.users().messages().get(userId='me', id=email['id'], **getArgs) for email in emailsChunk}
+            errors = await executeBatch(gmailService, emailRequests, storeEmailData)
+            # Emails that couldn't be fetched stay unread, for the next poll
+            for msgId, error in errors.items():
+                log.error('exception getEmailsData: %s: %s', msgId, error)
+
+        return emailsData
+    except Exception as e:
+        log.error('exception getEmailsData: %s', e)
+        return emailsData
 
-            path = './downloadedGmailPhotos/' + str(counter) + '.jpg'
-            with open(path, 'wb') as f:
-                f.write(file_data)
-            counter = counter + 1
+async def markEmailsRead(gmailService, msgIds):
+    """Removes the UNREAD label from a list of emails, using Gmail's batchModify
 
-async def uploadPhotosFromDownloaded(discordClient, loadedConfig, channelToSendTo):
-    """Uploads downloaded files from downloadPhotosFromEmail to Discord
+    Args:
+      gmailService: Gmail service
+      msgIds: Array of message ids to mark as read
+    Returns:
+      Void, removes the UNREAD label from the given emails
+    """
+
+    for msgIdsChunk in divideBy(msgIds, GMAIL_BATCH_MODIFY_SIZE):
+        labelToRemove = {
+            "ids": msgIdsChunk,
+            "removeLabelIds": [
+                'UNREAD'
+            ],
+            "addLabelIds": []
+        }
+        try:
+            # Remove unread label
+            await withRetry(runBlocking, gmailService.users().messages().batchModify(userId='me', body=labelToRemove).execute)
+        except Exception as e:
+            log.error('exception markEmailsRead: %s', e)
+
+def splitEmailParts(emailData):
+    """Splits the parts of an email into its attached photos and its text, in a single pass
 
     Args:
-      discordClient: Discord client
-      loadedConfig: configuration from yaml file
-      channelToSendTo: channel id to send message to
+      emailData: Email data to get the parts from
+    Returns:
+      Tuple of the array of photo parts, and the text/plain part (None if the email has no text)
+    """
+
+    photoParts = []
+    textPart = None
+    for part in emailData['payload']['parts']:
+        if part['filename'].endswith(PHOTO_EXTENSIONS):
+            photoParts.append(part)
+        elif textPart is None and part['mimeType'] == 'text/plain':
+            textPart = part
+    return photoParts, textPart
+
+async def fetchPhotoAttachments(gmailService, msgId, photoParts):
+    """Gets the base64 data of all attached photos from a passed-in email, using batched Gmail requests
 
+    Args:
+      gmailService: Gmail service
+      msgId: Message id of the email the photos are attached to
+      photoParts: Photo parts of the email, from splitEmailParts
     Returns:
-      Void, uploads images to Discord, and then deletes the file it uploaded from downloadedGmailPhotos
+      Array of url-safe base64 photo data, in the email's order
     """
-    discordChannel = discordClient.get_channel(channelToSendTo)
-    # Files to upload
-    filePath = './downloadedGmailPhotos'
-    imagesToUpload = [f for f in listdir(filePath) if isfile(join(filePath, f))]
-    for fileVal in imagesToUpload:
-        await discordChannel.send(file=discord.File(filePath + '/' + fileVal))
+
+    # Photo base64 data, keyed by the photo's index in photoParts
+    attachments = {}
+
+    def storeAttachment(requestId, response):
+        attachments[int(requestId)] = response['data']
+
+    # Small attachments already come inline with the email data, only the others need fetching
+    partsToFetch = []
+    for index, part in enumerate(photoParts):
+        if 'data' in part['body']:
+            attachments[index] = part['body']['data']
+        else:
+            partsToFetch.append((index, part))
+
+    for photoPartsChunk in divideBy(partsToFetch, GMAIL_ATTACHMENT_BATCH_SIZE):
+        attachmentRequests = {str(index): gmailService.users().messages().attachments().get(userId='me', messageId=msgId, id=part['body']['attachmentId']) for index, part in photoPartsChunk}
+        errors = await executeBatch(gmailService, attachmentRequests, storeAttachment)
+        # A missing photo should leave the email unread, so raise the first error
+        if errors:
+            raise next(iter(errors.values()))
+
+    return [attachments[index] for index in sorted(attachments)]
+
+async def streamPhotosToDiscord(attachments, discordChannel):
+    """Uploads all attached photos from a passed-in email to Discord, without writing them to disk
+
+    Args:
+      attachments: Array of url-safe base64 photo data, from fetchPhotoAttachments (emptied as the photos are sent)
+      discordChannel: Discord channel to send message to
+    Returns:
+      Void, uploads attached photos to Discord straight from memory
+    """
+
+    def takeAttachments():
+        # Hands over the photos one at a time, dropping them from attachments so sent photos aren't kept around
+        while attachments:
+            yield attachments.pop(0)
+
+    counter = 0
+    for photosChunk in divideByUploadSize(takeAttachments()):
+        # Decode in place, so each photo's base64 text is released once it's decoded and only this group is held
+        for i, photoData in enumerate(photosChunk):
+            photosChunk[i] = decodeUrlsafeBase64(photoData)
+        await discordChannel.send(files=[discord.File(io.BytesIO(photo), filename=str(counter + i) + '.jpg') for i, photo in enumerate(photosChunk)])
         await asyncio.sleep(1)
-        remove(filePath + '/' + fileVal)
+        counter = counter + len(photosChunk)
 
-async def sendTextFromEmail(emailData, discordClient, loadedConfig, channelToSendTo):
+async def sendTextFromEmail(textPart, loadedConfig, discordChannel):
     """Uploads the text contained in the email (versus the attachments)
 
     Args:
-      emailData: Email data to get text from
-      discordClient: Discord client
+      textPart: text/plain part of the email, from splitEmailParts
       loadedConfig: configuration from yaml file
-      channelToSendTo: channel id to send message to
+      discordChannel: Discord channel to send message to
 
     Returns:
       Void, uploads text from email to Discord
     """
 
-    for part in emailData['payload']['parts']:
-        if part['mimeType'] == 'text/plain':
-            base64text = part['body']['data']
-            # https://gist.github.com/perrygeo/ee7c65bb1541ff6ac770
-            # apparently there's no padding in certain cases, so we need to add it in
-            # we can add arbitrary padding length in, it'll ignore the rest of it.
-            toDecode = base64text + '======================='
-
-            messageText = ''
-            try:
-                # Parse body text
-                messageText = base64.b64decode(toDecode).decode('utf-8')
-            except:
-                e = sys.exc_info()[1]
-                print(e)
-
-            discordChannel = discordClient.get_channel(channelToSendTo)
-            await discordChannel.send(messageText)
-
-async def sendSubjectLineFromEmail(emailData, discordClient, loadedConfig, channelToSendTo):
+    if textPart is None:
+        return
+
+    base64text = textPart['body']['data']
+    # https://gist.github.com/perrygeo/ee7c65bb1541ff6ac770
+    # apparently there's no padding in certain cases, so we need to add it in
+    # Gmail bodies are url-safe base64, so only the exact padding is needed
+    toDecode = base64text + '=' * (-len(base64text) % 4)
+
+    messageText = ''
+    try:
+        # Parse body text
+        messageText = decodeUrlsafeBase64(toDecode).decode('utf-8')
+    except Exception as e:
+        log.error('exception sendTextFromEmail: %s', e)
+
+    await discordChannel.send(messageText)
+
+async def sendSubjectLineFromEmail(emailData, loadedConfig, discordChannel):
     """Uploads the subject line text to a Discord message
 
     Args:
       emailData: Email data to get subject line text from
-      discordClient: Discord client
       loadedConfig: configuration from yaml file
-      channelToSendTo: channel id to send message to
+      discordChannel: Discord channel to send message to
 
     Returns:
       Void, uploads text from subject line of an email to Discord
     """
 
-    for header in emailData['payload']['headers']:
-        if header['name'] == 'Subject':
-            discordChannel = discordClient.get_channel(channelToSendTo)
-            await discordChannel.send(header['value'])
+    headers = {header['name']: header['value'] for header in emailData['payload'].get('headers', [])}
+    subject = headers.get('Subject')
+    if subject is not None:
+        await discordChannel.send(subject)
 
 def getGmailLabel(gmailService, loadedConfig, labelKeyName):
     """Gets a Gmail label id, given the gmail service and string value defined in the config
@@ -211,16 +522,19 @@ def getGmailLabel(gmailService, loadedConfig, labelKeyName):
       Numerical string for the Gmail label id
     """
 
-    labelId = ''
-    results = gmailService.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
-    if labels:
-        labelId = ''
-        for label in labels:
-            if label['name'] == loadedConfig['gmail'][labelKeyName]['name']:
-                labelId = label['id']
-                break
-    return labelId
+    # Refresh the label name -> id map when it's never been loaded, or is out of date
+    if gmailLabelCache['labels'] is None or time.monotonic() - gmailLabelCache['fetched'] > GMAIL_LABEL_CACHE_TTL:
+        try:
+            results = gmailService.users().labels().list(userId='me').execute()
+            gmailLabelCache['labels'] = {label['name']: label['id'] for label in results.get('labels', [])}
+            gmailLabelCache['fetched'] = time.monotonic()
+        except Exception as e:
+            # Without a map there's nothing to fall back on, otherwise keep the old one and retry on the next call
+            if gmailLabelCache['labels'] is None:
+                raise
+            log.error('exception getGmailLabel: %s', e)
+
+    return gmailLabelCache['labels'].get(loadedConfig['gmail'][labelKeyName]['name'], '')
 
 def getLabelSendingChannel(labelName, loadedConfig):
     """Gets the channel for sending a message to, from a given labelName and the loaded config
@@ -239,84 +553,94 @@ def getLabelSendingChannel(labelName, loadedConfig):
     return channelToSendTo
 
 
-async def sendGmailAsDiscord(labelId, discordClient, gmailService, loadedConfig, channelToSendTo):
+async def sendGmailAsDiscord(labelId, gmailService, loadedConfig, discordChannel):
     """Main function to convert all unread Gmail emails under a certain label (defined in configs) to a series of Discord messages
     Args:
       labelId: Gmail label id
-      discordClient: Discord client
       gmailService: Gmail service
       loadedConfig: configuration from yaml file
-      channelToSendTo: channel id to send message to
+      discordChannel: Discord channel to send message to
     Returns:
       Void, Sends email photos and message content as Discord messages
     """
 
-    emails = getUnreadEmails(labelId, gmailService)
+    emails = await getUnreadEmails(labelId, gmailService)
+    # Only the parts are used, so skip the headers and snippet
+    emailsData = await getEmailsData(gmailService, emails, format='full', fields=GMAIL_PARTS_FIELDS)
+
+    async def fetchEmail(msgId, emailData):
+        photoParts, textPart = splitEmailParts(emailData)
+        attachments = await fetchPhotoAttachments(gmailService, msgId, photoParts)
+        return attachments, textPart
+
+    readMsgIds = []
+    emailItems = list(emailsData.items())
+    nextFetch = asyncio.ensure_future(fetchEmail(*emailItems[0])) if emailItems else None
+    for i, (msgId, emailData) in enumerate(emailItems):
+        # Fetch the next email's photos while this one posts, but post in email order
+        currentFetch = nextFetch
+        if i + 1 < len(emailItems):
+            nextFetch = asyncio.ensure_future(fetchEmail(*emailItems[i + 1]))
 
-    for email in emails:
         try:
-            emailData = gmailService.users().messages().get(userId='me', id=email['id']).execute()
-
-            downloadPhotosFromEmail(gmailService, emailData)
-            await uploadPhotosFromDownloaded(discordClient, loadedConfig, channelToSendTo)
-            await sendTextFromEmail(emailData, discordClient, loadedConfig, channelToSendTo)
-
-            labelToRemove = {
-                "removeLabelIds": [
-                    'UNREAD'
-                ],
-                "addLabelIds": []
-            }
-            try:
-                # Remove unread label
-                gmailService.users().messages().modify(userId='me', id=emailData['id'], body=labelToRemove).execute()
-            except:
-                pass
+            attachments, textPart = await currentFetch
+            # Keeps each email's photos and text together, even when another label posts to the same channel
+            async with getChannelLock(discordChannel):
+                await streamPhotosToDiscord(attachments, discordChannel)
+                await sendTextFromEmail(textPart, loadedConfig, discordChannel)
+            readMsgIds.append(msgId)
 
         except Exception as e:
-            print(e)
-            print('exception sendGmailAsDiscord')
-            continue
+            log.error('exception sendGmailAsDiscord: %s', e)
+
+    await markEmailsRead(gmailService, readMsgIds)
 
-async def sendGmailSubjectAsDiscord(labelId, discordClient, gmailService, loadedConfig, channelToSendTo):
+async def sendGmailSubjectAsDiscord(labelId, gmailService, loadedConfig, discordChannel):
     """Main function to convert all unread Gmail emails under a certain label (defined in configs) to a discord message (specifically, the email subject)
     Args:
       labelId: Gmail label id
-      discordClient: Discord client
       gmailService: Gmail service
       loadedConfig: configuration from yaml file
-      channelToSendTo: channel id to send message to
+      discordChannel: Discord channel to send message to
     Returns:
       Void, Sends email subject line content as a Discord message
     """
 
-    emails = getUnreadEmails(labelId, gmailService)
+    emails = await getUnreadEmails(labelId, gmailService)
+    # Only the subject is used, so skip the body and attachments
+    emailsData = await getEmailsData(gmailService, emails, format='metadata', metadataHeaders=['Subject'])
 
-    for email in emails:
+    readMsgIds = []
+    for msgId, emailData in emailsData.items():
 
-        print(email)
+        log.debug('Sending subject of email %s', msgId)
 
         try:
-            emailData = gmailService.users().messages().get(userId='me', id=email['id']).execute()
-
-            await sendSubjectLineFromEmail(emailData, discordClient, loadedConfig, channelToSendTo)
-
-            labelToRemove = {
-                "removeLabelIds": [
-                    'UNREAD'
-                ],
-                "addLabelIds": []
-            }
-            try:
-                # Remove unread label
-                gmailService.users().messages().modify(userId='me', id=emailData['id'], body=labelToRemove).execute()
-            except:
-                pass
+            async with getChannelLock(discordChannel):
+                await sendSubjectLineFromEmail(emailData, loadedConfig, discordChannel)
+            readMsgIds.append(msgId)
 
         except Exception as e:
-            print(e)
-            print('exception sendGmailSubjectAsDiscord')
-            continue
+            log.error('exception sendGmailSubjectAsDiscord: %s', e)
+
+    await markEmailsRead(gmailService, readMsgIds)
+
+async def sendAllGmailAsDiscord(discordClient):
+    """Converts the unread Gmail emails of every configured label to Discord messages, handling the labels concurrently
+
+    Args:
+      discordClient: Discord client, with its Gmail service, config and sending channels set
+    Returns:
+      Void, Sends the camera emails and the chore email subjects as Discord messages
+    """
+
+    # Label ids come from the cached label map, which gets refreshed here once it's out of date
+    discordClient.videoLabelId = await runBlocking(getGmailLabel, discordClient.gmailService, discordClient.loadedConfig, 'videoLabel')
+    discordClient.choreLabelId = await runBlocking(getGmailLabel, discordClient.gmailService, discordClient.loadedConfig, 'choreLabel')
+
+    await asyncio.gather(
+        sendGmailAsDiscord(discordClient.videoLabelId, discordClient.gmailService, discordClient.loadedConfig, discordClient.videoChannel),
+        sendGmailSubjectAsDiscord(discordClient.choreLabelId, discordClient.gmailService, discordClient.loadedConfig, discordClient.choreChannel))
 
 def sendWolPacket(wolComputerName, loadedConfig):
     """Sends a WOL packet to a valid computer name in the discord config yaml
@@ -328,16 +652,15 @@ def sendWolPacket(wolComputerName, loadedConfig):
     """
 
     if wolComputerName not in loadedConfig['wol']:
-        print('Invalid computer name for WOL')
+        log.warning('Invalid computer name for WOL: %s', wolComputerName)
         return
 
-    print('Sending WOL packet to ' + wolComputerName)
+    log.info('Sending WOL packet to %s', wolComputerName)
 
     try:
         send_magic_packet(loadedConfig['wol'][wolComputerName])
     except Exception as e:
-        print(e)
-        print('exception sendWolPacket')
+        log.error('exception sendWolPacket: %s', e)
 
 def sendLocalWebhookGET(webhookName, loadedConfig):
     """Sends a GET request to a valid local webhook in the discord config yaml
@@ -349,10 +672,10 @@ def sendLocalWebhookGET(webhookName, loadedConfig):
     """
 
     if webhookName not in loadedConfig['webhook']:
-        print('Invalid computer name for webhook')
+        log.warning('Invalid computer name for webhook: %s', webhookName)
         return
 
-    print('Sending webhook to ' + webhookName)
+    log.info('Sending webhook to %s', webhookName)
 
     try:
         ipAddress = loadedConfig['webhook'][webhookName]['ip']
@@ -364,8 +687,7 @@ def sendLocalWebhookGET(webhookName, loadedConfig):
 
         requests.get(url, headers=headers)
     except Exception as e:
-        print(e)
-        print('exception sendLocalWebhookGET')
+        log.error('exception sendLocalWebhookGET: %s', e)
 
 # Discord client class
 class MyClient(discord.Client):
@@ -373,6 +695,8 @@ class MyClient(discord.Client):
     videoLabelSendingChannel = None
     choreLabelId = None
     choreLabelSendingChannel = None
+    videoChannel = None
+    choreChannel = None
     gmailService = None
     loadedConfig = None
 
@@ -385,7 +709,7 @@ class MyClient(discord.Client):
           Void, logs a success message
         """
 
-        print('Logged on as {0}!'.format(self.user))
+        log.info('Logged on as %s!', self.user)
 
     async def on_message(self, message):
         """On_Message function, fired whenever a discord message is noticed in the server
@@ -397,12 +721,11 @@ class MyClient(discord.Client):
           Void, logs a message and handles message text appropriately (if applicable)
         """
 
-        print('Message from {0.author}: {0.content}'.format(message))
+        log.debug('Message from %s: %s', message.author, message.content)
 
         if message.content == '!checkEmail':
-            await sendGmailAsDiscord(videoLabelId, self, gmailService, loadedConfig, videoLabelSendingChannel)
-            await sendGmailSubjectAsDiscord(choreLabelId, self, gmailService, loadedConfig, choreLabelSendingChannel)
-            print('Check Email Manually triggered')
+            await sendAllGmailAsDiscord(self)
+            log.info('Check Email Manually triggered')
         if message.content.startswith('!wol'):
             wolComputer = message.content.removeprefix('!wol ')
             sendWolPacket(wolComputer, loadedConfig)
@@ -411,6 +734,56 @@ class MyClient(discord.Client):
             sendLocalWebhookGET(webhookComputer, loadedConfig)
 
 # Generic helper functions
+def divideBy(items, size):
+    """Helper function for splitting a list into consecutive chunks
+
+    Args:
+      items: List to split
+      size: Max number of items in each chunk
+    Returns:
+      Generator of lists, each holding at most "size" items
+    """
+
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def divideByUploadSize(photosData):
+    """Helper function for grouping base64 photos into as few Discord messages as the attachment limits allow
+
+    Args:
+      photosData: Iterable of base64 photo data to group, consumed one photo at a time
+    Returns:
+      Generator of lists, each with at most DISCORD_MAX_ATTACHMENTS photos and DISCORD_MAX_UPLOAD_BYTES decoded in total
+      (a single photo over the byte limit still gets its own list)
+    """
+
+    photosChunk = []
+    chunkBytes = 0
+    for photoData in photosData:
+        # Sized from the base64 text, so nothing has to be decoded to build the groups
+        photoBytes = len(photoData) * 3 // 4
+        if photosChunk and (len(photosChunk) == DISCORD_MAX_ATTACHMENTS or chunkBytes + photoBytes > DISCORD_MAX_UPLOAD_BYTES):
+            yield photosChunk
+            photosChunk = []
+            chunkBytes = 0
+        photosChunk.append(photoData)
+        chunkBytes = chunkBytes + photoBytes
+    if photosChunk:
+        yield photosChunk
+
+def getChannelLock(discordChannel):
+    """Helper function for getting the lock that serializes posting emails to a Discord channel
+
+    Args:
+      discordChannel: Discord channel to get the lock for
+    Returns:
+      asyncio Lock for the channel
+    """
+
+    if discordChannel.id not in discordChannelLocks:
+        discordChannelLocks[discordChannel.id] = asyncio.Lock()
+    return discordChannelLocks[discordChannel.id]
+
 async def do_stuff_every_x_seconds(timeout, stuff, *args):
     """Helper function for calling an async function every timeout seconds
 
@@ -426,8 +799,9 @@ async def do_stuff_every_x_seconds(timeout, stuff, *args):
         await asyncio.sleep(timeout)
         await stuff(*args)
 
-# Pulling in config parameters
-loadedConfig = yaml.safe_load(open("./piDiscordConfig.yaml"))
+# Pulling in config parameters, with the LibYAML parser when PyYAML was built with it
+with open("./piDiscordConfig.yaml") as configFile:
+    loadedConfig = yaml.load(configFile, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
 # Gmail initialization
 gmailService = gmailInitialize(loadedConfig)
@@ -439,6 +813,24 @@ choreLabelSendingChannel = getLabelSendingChannel('choreLabel', loadedConfig)
 # Discord client initialization
 client = MyClient(intents=discord.Intents.all())
 
+async def startGmailPolling(discordClient):
+    """Resolves the Discord channels to send Gmail messages to, then starts polling Gmail
+
+    Args:
+      discordClient: Discord client, with its label ids and sending channel ids set
+    Returns:
+      Void, adds the Gmail polling loop into the discord client event loop once the client is ready
+    """
+
+    # Channels are only known once the client has connected, and are looked up once here instead of per message
+    await discordClient.wait_until_ready()
+    discordClient.videoChannel = discordClient.get_channel(discordClient.videoLabelSendingChannel)
+    discordClient.choreChannel = discordClient.get_channel(discordClient.choreLabelSendingChannel)
+
+    # Start checking every 5 minutes to send Gmail camera and chore notification emails as discord messages
+    # Both labels are handled in the same wakeup, added into the discord client event loop
+    discordClient.loop.create_task(do_stuff_every_x_seconds(300, sendAllGmailAsDiscord, discordClient))
+
 async def main():
     async with client:
         if len(videoLabelId) and len(choreLabelId):
@@ -449,15 +841,7 @@ async def main():
           client.gmailService = gmailService
           client.loadedConfig = loadedConfig
 
-          # Start checking every 5 minutes to send Gmail camera emails as discord messages
-          # Added into the discord client event loop
-          client.loop.create_task(do_stuff_every_x_seconds(300, sendGmailAsDiscord, videoLabelId, client, gmailService, loadedConfig, videoLabelSendingChannel))
-
-          await asyncio.sleep(60)
-
-          # Start checking every 5 minutes to send Gmail chore notification emails as discord messages
-          # Added into the discord client event loop
-          client.loop.create_task(do_stuff_every_x_seconds(300, sendGmailSubjectAsDiscord, choreLabelId, client, gmailService, loadedConfig, choreLabelSendingChannel))
+          client.loop.create_task(startGmailPolling(client))
 
         # Starting the discord bot
         await client.start(loadedConfig['discord']['clientToken'])